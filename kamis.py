@@ -0,0 +1,379 @@
+# Shared KAMIS scraping + BigQuery publishing logic for every commodity class.
+# Import Packages
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+from datetime import datetime, timedelta
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import aiohttp
+import asyncio
+import concurrent.futures
+import lxml.html
+import gzip
+import hashlib
+import os
+import re
+import time
+
+# Configure concurrency + retry behaviour for aiohttp
+CONCURRENCY = 16  # Fetch at most 16 pages at a time
+PER_PAGE = 3000  # Rows per KAMIS page
+MAX_RETRIES = 5  # Try at most 5 times per request
+BACKOFF_FACTOR = 2  # Exponential backoff: wait 2s, then 4s, then 8s... between retries
+RETRY_STATUSES = [429,500,502,503,504]  # Only retry on these HTTP status codes
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=60)
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Accept-Encoding": "gzip",  # KAMIS tables are repetitive markup: gzip cuts transfer bytes ~5-10x
+    "Connection": "keep-alive",
+}
+
+# Column headers of the KAMIS market prices table
+KAMIS_COLUMNS = [
+    "Commodity", "Classification", "Grade", "Sex", "Market",
+    "Wholesale", "Retail", "Supply Volume", "County", "Date",
+]
+
+# Precomputed header -> column mapping: the headers are fixed, so cleaning
+# them with a four-pass string chain on every run is wasted work
+COLUMN_MAP = {
+    "Commodity": "commodity",
+    "Classification": "classification",
+    "Grade": "grade",
+    "Sex": "sex",
+    "Market": "market",
+    "Wholesale": "wholesale",
+    "Retail": "retail",
+    "Supply Volume": "supply_volume",
+    "County": "county",
+    "Date": "date",
+}
+
+_CLEAN_RE = re.compile(r"[^0-9a-zA-Z_]")
+
+def clean_column(name):
+    """Fallback cleaner for headers missing from COLUMN_MAP."""
+    return _CLEAN_RE.sub("", name.strip().lower().replace(" ", "_"))
+
+# Explicit load schema: autodetect stays off so every monthly table gets
+# identical types regardless of what the sampled rows look like
+SCHEMA = [
+    bigquery.SchemaField("commodity", "STRING"),
+    bigquery.SchemaField("classification", "STRING"),
+    bigquery.SchemaField("grade", "STRING"),
+    bigquery.SchemaField("sex", "STRING"),
+    bigquery.SchemaField("market", "STRING"),
+    bigquery.SchemaField("wholesale", "FLOAT"),
+    bigquery.SchemaField("retail", "FLOAT"),
+    bigquery.SchemaField("supply_volume", "FLOAT"),
+    bigquery.SchemaField("county", "STRING"),
+    bigquery.SchemaField("date", "DATE"),
+]
+
+# Raw pages are cached on disk so a rerun after a downstream failure skips
+# the network entirely; the TTL keeps scheduled runs fetching fresh data
+CACHE_DIR = ".kamis_cache"
+CACHE_TTL = 6 * 3600  # seconds
+
+PROJECT = 'data-storage-485106'
+
+now = datetime.now()
+year = now.year
+month = now.strftime("%b").lower()  # jan, feb, mar
+table_suffix = f"{year}_{month}"
+
+# Initialize BigQuery client
+client = bigquery.Client(project=PROJECT)
+
+def make_session():
+    """Build the shared aiohttp session used by every commodity class."""
+    # Size the pool to the fetch wave and keep sockets alive between waves
+    connector = aiohttp.TCPConnector(limit=32, limit_per_host=32, keepalive_timeout=60, ssl=False)
+    return aiohttp.ClientSession(connector=connector, timeout=REQUEST_TIMEOUT, headers=HEADERS)
+
+def load_in_chunks(df, table_id, schema, rows_per_job=500_000):
+    """Load a frame into BigQuery in bounded batches to cap Parquet encode memory."""
+    job_config = bigquery.LoadJobConfig(write_disposition="WRITE_APPEND", schema=schema)
+    for start in range(0, len(df), rows_per_job):
+        job = client.load_table_from_dataframe(
+            df.iloc[start:start + rows_per_job], table_id, job_config=job_config
+        )
+        job.result()
+
+def cache_path(url):
+    return os.path.join(CACHE_DIR, hashlib.blake2b(url.encode()).hexdigest() + ".html.gz")
+
+def cache_read(url):
+    """Return cached page bytes if present and fresh, else None."""
+    path = cache_path(url)
+    try:
+        if time.time() - os.path.getmtime(path) < CACHE_TTL:
+            with gzip.open(path, "rb") as fh:
+                return fh.read()
+    except OSError:
+        pass  # missing or unreadable cache entry: fetch normally
+    return None
+
+def cache_write(url, content):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # level 1: the point is cheap disk reuse, not maximum compression
+    with gzip.open(cache_path(url), "wb", compresslevel=1) as fh:
+        fh.write(content)
+
+async def fetch_page(session, url, semaphore):
+    """Fetch one KAMIS page, retrying transient failures with backoff."""
+    cached = cache_read(url)
+    if cached is not None:
+        print(f"Cache hit: {url}")
+        return cached
+
+    async with semaphore:
+        for attempt in range(MAX_RETRIES):
+            try:
+                print(f"Fetching: {url}")
+                async with session.get(url) as response:
+                    if response.status in RETRY_STATUSES:
+                        response.raise_for_status()
+                    content = await response.read()
+                    # Only cache good pages: a cached 403/404 body would be
+                    # served as a hit for hours and read as end-of-data
+                    if response.status == 200:
+                        cache_write(url, content)
+                    return content
+            except Exception:
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                await asyncio.sleep(BACKOFF_FACTOR * 2 ** attempt)
+
+def extract_numeric(series):
+    """Pull the leading number out of a price column, e.g. "3500.00/Kg" -> 3500.0."""
+    # Arrow's RE2 engine runs the regex over the whole column at once instead
+    # of pandas' per-row object path
+    matches = pc.extract_regex(pa.Array.from_pandas(series.astype(str)), r'(?P<num>\d+\.?\d*)')
+    return pc.cast(pc.struct_field(matches, "num"), pa.float64()).to_pandas()
+
+# Parsing is CPU-bound lxml work: a process pool lets the workers chew on
+# page K while the event loop fetches page K+1. Created lazily so importing
+# this module doesn't spawn workers.
+_parse_pool = None
+
+def parse_pool():
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _parse_pool
+
+def parse_page(content):
+    """Parse the market prices table out of one page of KAMIS HTML."""
+    # Parsing the raw bytes with lxml skips the decode pass and only builds
+    # the one table we want, unlike pd.read_html which materializes them all
+    root = lxml.html.fromstring(content)
+    # (//table)[1] is the first table in document order; //table[1] would
+    # also match every nested table that is first among its own siblings
+    rows = root.xpath('(//table)[1]//tr')
+    data = [
+        [td.text_content().strip() for td in row.xpath('./td')]
+        for row in rows[1:]
+    ]
+    data = [row for row in data if len(row) == len(KAMIS_COLUMNS)]
+    if not data:
+        return None  # no table on the page: we paged past the data
+    return data
+
+async def scrape(session, commodities):
+    # Collect plain row lists and build a single frame at the end: one dtype
+    # inference pass instead of one per page plus a concat
+    records = []
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    loop = asyncio.get_running_loop()
+
+    # Loop through commodities
+    for commodity in commodities:
+        base_url = "https://kamis.kilimo.go.ke/site/market{}?product=" + str(commodity)+ f"&per_page={PER_PAGE}"
+
+        # Define Offset
+        offset = 0
+        prev_page_key = None
+
+        # Run
+        while True:
+            # Fetch the next wave of pages concurrently
+            # (first page has no offset in its URL)
+            urls = [
+                base_url.format("" if o == 0 else f"/{o}")
+                for o in range(offset, offset + CONCURRENCY * PER_PAGE, PER_PAGE)
+            ]
+            results = await asyncio.gather(
+                *[fetch_page(session, url, semaphore) for url in urls],
+                return_exceptions=True,
+            )
+
+            # Hand the whole wave to the worker processes and gather, so the
+            # pages parse in parallel across cores rather than one at a time.
+            # Fetch errors pass through unparsed; parse errors (lxml raises
+            # on garbage bodies) are captured in place by return_exceptions
+            parsed = await asyncio.gather(
+                *[
+                    asyncio.sleep(0, result=result) if isinstance(result, Exception)
+                    else loop.run_in_executor(parse_pool(), parse_page, result)
+                    for result in results
+                ],
+                return_exceptions=True,
+            )
+
+            done = False
+            for url, page_rows in zip(urls, parsed):
+                if isinstance(page_rows, Exception):
+                    print(f"[WARN] KAMIS fetch or parse error for {url}: {page_rows}")
+                    done = True
+                    break  # stop paging for this commodity, continue script
+
+                if page_rows is None:
+                    done = True
+                    break
+
+                # A partial page is the last page: stop paging this commodity
+                if len(page_rows) < PER_PAGE:
+                    records.extend(page_rows)
+                    done = True
+                    break
+
+                # Offsets past the end re-serve the final page: skip repeats.
+                # Hash every cell - single-product queries have a constant
+                # first column, so anything less collides across real pages
+                page_key = hash(tuple(map(tuple, page_rows)))
+                if page_key == prev_page_key:
+                    done = True
+                    break
+                prev_page_key = page_key
+
+                records.extend(page_rows)
+
+            if done:
+                break
+            offset += CONCURRENCY * PER_PAGE
+
+    return pd.DataFrame.from_records(records, columns=KAMIS_COLUMNS) if records else pd.DataFrame()
+
+def clean(bigdata, drop_columns=()):
+    """Normalize column names and dtypes on a freshly scraped frame."""
+    # Clean Names
+    bigdata.columns = [COLUMN_MAP.get(column, clean_column(column)) for column in bigdata.columns]
+
+    # Standardize Data Types
+    # KAMIS serves one fixed date format; naming it keeps pandas on the C
+    # parser, and cache=True parses each distinct date string only once
+    bigdata['date'] = pd.to_datetime(bigdata['date'], format='%Y-%m-%d', cache=True, errors='coerce')
+    bigdata['wholesale'] = extract_numeric(bigdata['wholesale'])
+    bigdata['retail'] = extract_numeric(bigdata['retail'])
+    bigdata['supply_volume'] = pd.to_numeric(bigdata['supply_volume'], errors='coerce')
+
+    # Drop Variables
+    if drop_columns:
+        bigdata.drop(columns=list(drop_columns), inplace=True)
+
+    # Arrow-backed dtypes: the load jobs convert to Arrow/Parquet anyway, so
+    # holding the low-cardinality string columns in Arrow from the start skips
+    # the object-dtype conversion pass and shrinks the frame
+    string_columns = ['commodity', 'classification', 'grade', 'sex', 'market', 'county']
+    bigdata = bigdata.astype({
+        column: 'string[pyarrow]' for column in string_columns
+        if column in bigdata.columns
+    })
+    bigdata['date'] = bigdata['date'].astype('date32[pyarrow]')
+    return bigdata
+
+def publish(bigdata, dataset, schema):
+    """Load a cleaned frame into the dataset's monthly table and deduplicate it."""
+    # Define Table ID
+    table_id = f"{PROJECT}.{dataset}.market_prices_{table_suffix}"
+
+    if now.day == 1 or now.day == 2:
+
+        # Check if current month table already has current month data.
+        # Existence comes from INFORMATION_SCHEMA (metadata only, free); the
+        # data probe is a LIMIT 1 on a plain date predicate, which prunes,
+        # instead of a COUNT(*) sweep behind a CAST that scans every byte
+        exists_sql = f"""
+                     SELECT table_name
+                     FROM `{PROJECT}.{dataset}.INFORMATION_SCHEMA.TABLES`
+                     WHERE table_name = 'market_prices_{table_suffix}'
+                     """
+        if not list(client.query(exists_sql).result()):
+            has_current_month_data = False  # Table doesn't exist yet
+        else:
+            check_sql = f"""
+                        SELECT 1
+                        FROM `{table_id}`
+                        WHERE date >= DATE('{now:%Y-%m}-01')
+                        LIMIT 1
+                        """
+            has_current_month_data = bool(list(client.query(check_sql).result()))
+
+        if not has_current_month_data:
+            try:
+                prev_month_date = now.replace(day=1) - timedelta(days=1)
+                prev_table_suffix = f"{prev_month_date.year}_{prev_month_date.strftime('%b').lower()}"
+                prev_table_id = f"{PROJECT}.{dataset}.market_prices_{prev_table_suffix}"
+
+                # Load today's scrape first, then append last month's rows with a
+                # server-side INSERT: the previous table never leaves BigQuery
+                load_in_chunks(bigdata, table_id, schema)
+                print(f"All data loaded into {table_id}, total rows: {len(bigdata)}")
+
+                try:
+                    insert_job = client.query(
+                        f"INSERT INTO `{table_id}` SELECT * FROM `{prev_table_id}`"
+                    )
+                    insert_job.result()
+                    print(f"Appended {insert_job.num_dml_affected_rows} rows from previous month table.")
+                except NotFound:
+                    print("No previous month table found, skipping append.")
+
+            except Exception as e:
+                print(f"Error during 1st-of-month load: {e}")
+
+    else:
+        load_in_chunks(bigdata, table_id, schema)
+        print(f"Normal load completed into {table_id}, rows: {len(bigdata)}")
+
+    # Count duplicates from table metadata (free) rather than hashing every
+    # row in pandas: rows before dedup minus rows after
+    rows_before = client.get_table(table_id).num_rows
+
+    # Deduplicate in BigQuery: one query on the warehouse instead of downloading
+    # every row, dropping duplicates in pandas, and re-uploading the table.
+    # The dedup key is every column, so DISTINCT * does the job - and unlike
+    # an analytic PARTITION BY it is allowed on the FLOAT64 price columns
+    dedup_sql = (f"""
+            CREATE OR REPLACE TABLE `{table_id}` AS
+            SELECT DISTINCT *
+            FROM `{table_id}`;
+           """)
+    client.query(dedup_sql).result()
+
+    # Return Data Info
+    rows = client.get_table(table_id).num_rows
+    print(f"Removed {rows_before - rows} duplicate records.")
+    print(f"{dataset.capitalize()} data has been successfully retrieved, deduplicated, and appended to the BigQuery table ({rows} rows).")
+
+async def run_category(category, commodities, session, drop_columns=()):
+    """Scrape one commodity class and publish it to its BigQuery dataset."""
+    bigdata = await scrape(session, commodities)
+    print(f"Collected {len(bigdata)} rows for {category}")
+
+    if bigdata.empty:
+        print(f"[WARN] No {category} data collected from KAMIS. Skipping BigQuery load.")
+        return
+
+    bigdata = clean(bigdata, drop_columns)
+    schema = [field for field in SCHEMA if field.name not in drop_columns]
+
+    # The BigQuery client blocks, so push publishing off the event loop to
+    # keep the other categories scraping in the meantime
+    await asyncio.to_thread(publish, bigdata, category, schema)
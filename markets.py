@@ -0,0 +1,26 @@
+# Scrape every commodity class in one program, sharing a single aiohttp
+# session and BigQuery client so the categories overlap instead of running
+# back to back.
+import asyncio
+
+import kamis
+
+# Define Commodities
+FERTILIZER = [
+    217, # Fertilizer
+]
+
+LIVESTOCK = [
+    140, # Cattle
+    167, # Sheep
+    227, # Chicken
+]
+
+async def main():
+    async with kamis.make_session() as session:
+        await asyncio.gather(
+            kamis.run_category("fertilizer", FERTILIZER, session, drop_columns=("grade", "sex")),
+            kamis.run_category("livestock", LIVESTOCK, session),
+        )
+
+asyncio.run(main())